@@ -1,47 +1,73 @@
 import os
+import functools
+import json
 import yaml
+import tempfile
+import numpy as np
 import pandas as pd
+from pathlib import Path
 import yfinance as yf
 from dotenv import load_dotenv
 from typing import Any, Optional
 import snowflake.connector as sfc
-from snowflake.connector.pandas_tools import write_pandas
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 # Use tuple to guarantee unique tickers and cause more memory efficient.
 stock_tickers: list[str] = ['NAB.AX', 'WBC.AX', 'ANZ.AX', 'BEN.AX', 'BOQ.AX', 'BFL.AX', 'JDO.AX', 'HGH.AX', 'MYS.AX', 'KSL.AX', 'BBC.AX']
 
+# Profile fields rarely change, so fetched profiles are cached locally and only refetched once older than the TTL.
+_PROFILE_CACHE: Path = Path("~/.cache/stocks_dbt/profiles.parquet").expanduser()
+_PROFILE_TTL: pd.Timedelta = pd.Timedelta(days=7)
+_PROFILE_COLUMNS: list[str] = ["TICKER", "COMPANY_NAME", "INDUSTRY", "SECTOR", "COUNTRY", "CLASS", "MARKET_CAP"]
+
+# Snowflake connection settings read once at import, unset keys are left out so account defaults apply.
+load_dotenv()
+_SF_KW: dict[str, str] = {
+    k: v for k in ('user', 'password', 'account', 'warehouse', 'database', 'schema', 'role')
+    if (v := os.getenv(k)) is not None
+}
+
 class yf_data:
     def __init__(self, tickers: tuple[str]) -> None:
         self.tickers: tuple[str] = tickers
 
-    def price_data(self) -> pd.DataFrame:
+    def price_data(self, tickers: Optional[tuple[str]] = None, start: Optional[str] = None) -> pd.DataFrame:
         """
         Method to source all historical data available for tickers in self.tickers
         This method defaults to using the 1d interval.
         Concurrency not required as yf.download already supports it.
+        Do not wrap in a thread pool, yf.download keeps its results in shared module level state.
+
+        Parameters:
+            tickers : Optional[tuple[str]] -> Subset of tickers to download, self.tickers when None.
+            start : Optional[str] -> First date (YYYY-MM-DD) to download from, full history when None.
 
         Returns
             data : pd.DataFrame
                 A dataframe containing the cleaned data.
         """
         data: Optional[pd.DataFrame] = yf.download(
-            tickers=self.tickers,
-            period='max',
+            tickers=' '.join(self.tickers if tickers is None else tickers),
+            **({'period': 'max'} if start is None else {'start': start}),
             group_by='ticker',
             auto_adjust=False
         )
 
-        data: pd.DataFrame = data.stack(level=0).reset_index()
-        data.columns = (
-            data.columns
-            .str.strip()
-            .str.replace(r"^['\"]|['\"]$", "", regex=True)
-            .str.upper()
-            .str.replace(' ', '_')
-        )
-        data['DATE'] = pd.to_datetime(data['DATE']).dt.date
+        # One sub-frame per ticker, dropna discards dates a ticker has no data for.
+        frames: list[pd.DataFrame] = []
+        for tkr in data.columns.get_level_values(0).unique():
+            sub: pd.DataFrame = data[tkr].dropna(how='all').copy()
+            sub["TICKER"] = tkr
+            frames.append(sub.reset_index())
+
+        if not frames:
+            return pd.DataFrame()
+
+        data: pd.DataFrame = pd.concat(frames, ignore_index=True)
+        data.rename(columns=lambda c: c.strip().strip("'\"").upper().replace(' ', '_'), inplace=True)
+        # datetime64 truncated to day precision.
+        data['DATE'] = pd.to_datetime(data['DATE'], utc=False).values.astype('datetime64[D]')
 
         return data
 
@@ -73,35 +99,65 @@ class yf_data:
     def threaded_profiling(self) -> pd.DataFrame:
         """
         Method that calls ThreadedPoolExecutor to process profiles concurrently instead of sequentially.
-        Adjusts concurrent workers based on min of cpu_count() or number of tickers to evaluate.
-        
+        Profile fetches are network bound, so workers are capped at 32 (or number of tickers).
+        Only tickers missing from the local cache, or cached longer than _PROFILE_TTL ago, are fetched.
+
         Returns
             pd.DataFrame
         """
+        now: pd.Timestamp = pd.Timestamp.now()
+        cache: pd.DataFrame = (
+            pd.read_parquet(_PROFILE_CACHE) if _PROFILE_CACHE.exists()
+            else pd.DataFrame(columns=[*_PROFILE_COLUMNS, "FETCHED_AT"])
+        )
+        fetched_at: dict[str, pd.Timestamp] = dict(zip(cache["TICKER"], cache["FETCHED_AT"]))
+        stale: list[str] = [t for t in self.tickers if t not in fetched_at or fetched_at[t] < now - _PROFILE_TTL]
+
         results: list = []
-        with ThreadPoolExecutor(max_workers=min(os.cpu_count(), len(self.tickers))) as thread:
-            future_ticker = {thread.submit(self.profile_data, t): t for t in self.tickers}
-            for future in as_completed(future_ticker):
-                results.append(future.result())
-        return pd.DataFrame(data=results)
+        if stale:
+            with ThreadPoolExecutor(max_workers=min(32, len(stale))) as thread:
+                future_ticker = {thread.submit(self.profile_data, t): t for t in stale}
+                for future in as_completed(future_ticker):
+                    # Keyed by the submitted ticker, info["symbol"] can be missing or formatted differently.
+                    results.append({**future.result(), "TICKER": future_ticker[future]})
+
+            fetched: pd.DataFrame = pd.DataFrame.from_records(results, columns=_PROFILE_COLUMNS)
+            fetched["FETCHED_AT"] = now
+            cache: pd.DataFrame = pd.concat([cache[~cache["TICKER"].isin(fetched["TICKER"])], fetched], ignore_index=True)
+            cache: pd.DataFrame = cache.astype({"MARKET_CAP": "Int64", "FETCHED_AT": "datetime64[ns]"})
+            _PROFILE_CACHE.parent.mkdir(parents=True, exist_ok=True)
+            cache.to_parquet(_PROFILE_CACHE, index=False)
+
+        return (
+            cache.loc[cache["TICKER"].isin(self.tickers), _PROFILE_COLUMNS]
+            .reset_index(drop=True)
+            .astype({"MARKET_CAP": "Int64"})
+        )
+
+@functools.lru_cache(maxsize=1)
+def _get_conn() -> sfc.SnowflakeConnection:
+    """
+    Opens the Snowflake connection once per process and reuses it across pipeline instances,
+    so the auth and TLS handshake is not repeated for every run.
+    """
+    return sfc.connect(**_SF_KW)
 
 class pipeline:
     def __init__(self, tickers: tuple[str], db_schema: str) -> None:
-        load_dotenv()
-        self.tickers: list[tuple] = tickers
+        # Upper-cased and deduplicated.
+        self.tickers: tuple[str] = tuple({t.upper() for t in tickers})
         self.db_schema: str = db_schema
         self.yf_data: yf_data = yf_data(tickers=self.tickers)
-        self.conn: Optional[sfc.SnowflakeConnection] = sfc.connect(
-            user=os.getenv(key='user'),
-            password=os.getenv(key='password'),
-            account=os.getenv(key='account'),
-            warehouse=os.getenv(key='warehouse'),
-            database=os.getenv(key='database'),
-            schema=os.getenv(key='schema'),
-            role=os.getenv(key='role')
-        )
+        self.conn: Optional[sfc.SnowflakeConnection] = _get_conn()
         self.cursor: Optional[sfc.SnowflakeCursor] = self.conn.cursor()
 
+    def __enter__(self) -> "pipeline":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        # Only the cursor is closed, the cached connection is left open for the next pipeline.
+        self.cursor.close()
+
     def table_creator(self) -> None:
         """
         Method to read yaml file containing all required db table schemas and create them if they dont exist.
@@ -111,10 +167,52 @@ class pipeline:
         with open(self.db_schema, "r") as f:
             schema: Any = yaml.safe_load(f)
 
-        for table, columns in schema.items():
-            cols: list[str] = [f"{col} {dtype}" for col, dtype in columns.items()]
-            sql: str = f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(cols)});"
-            self.cursor.execute(sql)
+        script: str = "\n".join(
+            f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(f'{col} {dtype}' for col, dtype in columns.items())});"
+            for table, columns in schema.items()
+        )
+        self.conn.execute_string(script, remove_comments=True)
+
+    def _stage_parquet_copy(self, df: pd.DataFrame, table: str) -> None:
+        """
+        Method to bulk load a dataframe into a Snowflake table.
+        Writes the dataframe out as a few equal sized parquet files, uploads them with a single parallel PUT
+        and loads them with one server side COPY INTO.
+
+        Parameters:
+            df : pd.DataFrame -> Data to load, column names must match the target table.
+            table : str -> Name of the target table.
+        """
+        # Snappy is compression inside the parquet files, so PUT treats them as uncompressed.
+        # USE_LOGICAL_TYPE so parquet date/timestamp columns load by their logical type.
+        # Stage is cleared first so files left behind by a failed PUT or COPY are not loaded again.
+        with tempfile.TemporaryDirectory() as d:
+            n_chunks: int = max(1, len(df) // 250_000)
+            for i, idx in enumerate(np.array_split(np.arange(len(df)), n_chunks)):
+                df.iloc[idx].to_parquet(os.path.join(d, f"p{i}.parquet"), compression="snappy", index=False)
+
+            self.cursor.execute(f"REMOVE @~/stg_{table}")
+            self.cursor.execute(
+                f"PUT 'file://{d}/*.parquet' @~/stg_{table} "
+                f"PARALLEL=8 AUTO_COMPRESS=FALSE SOURCE_COMPRESSION=NONE OVERWRITE=TRUE"
+            )
+            self.cursor.execute(
+                f"COPY INTO {table} FROM @~/stg_{table} "
+                f"FILE_FORMAT=(TYPE=PARQUET USE_LOGICAL_TYPE=TRUE) MATCH_BY_COLUMN_NAME=CASE_INSENSITIVE PURGE=TRUE"
+            )
+
+    def _stage_df(self, df: pd.DataFrame, stg_name: str, like: str) -> None:
+        """
+        Method to upload a dataframe into a fresh transient staging table shaped like an existing table.
+        Transient as staging data is rebuilt every run and does not need fail-safe storage.
+
+        Parameters:
+            df : pd.DataFrame -> Data to stage.
+            stg_name : str -> Name of the staging table, replaced on every call.
+            like : str -> Existing table whose columns the staging table copies.
+        """
+        self.cursor.execute(f"CREATE OR REPLACE TRANSIENT TABLE {stg_name} LIKE {like}")
+        self._stage_parquet_copy(df=df, table=stg_name)
 
     def date_checker(self) -> pd.DataFrame:
         """
@@ -125,95 +223,116 @@ class pipeline:
             filter_df : pd.DataFrame
                 A dataframe containing each currently available ticker and their latest date values.
         """
-        tickers_list: str = ', '.join([f"'{t}'" for t in self.tickers])
-        query: str = f"""
+        query: str = """
             SELECT
                 ticker,
                 MAX(date) AS max_date
             FROM
                 stock_data.historical_data.ticker_data
             WHERE
-                ticker IN ({tickers_list})
+                ticker IN (SELECT value::string FROM TABLE(FLATTEN(input => PARSE_JSON(%s))))
             GROUP BY
                 ticker
         """
 
-        filter_df: pd.DataFrame = pd.read_sql_query(sql=query, con=self.conn)
-        filter_df['MAX_DATE'] = pd.to_datetime(filter_df['MAX_DATE']).dt.date
+        # Tickers bound as a single JSON array parameter.
+        self.cursor.execute(query, (json.dumps(list(self.tickers)),))
+        filter_df: pd.DataFrame = self.cursor.fetch_pandas_all()
+        filter_df['MAX_DATE'] = pd.to_datetime(filter_df['MAX_DATE'], utc=False).values.astype('datetime64[D]')
 
         return filter_df
 
-    def load_price_data(self) -> Optional[pd.Series]:
+    def load_price_data(self) -> int:
         """
-        Method to compare sourced price data against what currently exists in Snowflake db.
-        To avoid ingesting duplicate data, filter to only keep rows where:
-            a) Ticker exists and rows are greater than the max date of that ticker in the database.
-            b) Ticker does not currently exist in db.
+        Method to load sourced price data into the Snowflake db without ingesting duplicates.
+        Sourced data is staged into a transient table and MERGE'd into TICKER_DATA, so only rows where
+        the (ticker, date) pair does not already exist are inserted.
+        Tickers already in the db only download from the business day after the oldest of their latest dates,
+        tickers not yet in the db download their full history.
 
         Returns
-            pd.Series -> Count of rows per ticker.
+            int -> Count of new rows ingested.
         """
-        df: pd.DataFrame = self.yf_data.price_data()
         filter_df: pd.DataFrame = self.date_checker()
+        existing: tuple[str] = tuple(filter_df['TICKER'])
+        missing: tuple[str] = tuple(t for t in self.tickers if t not in set(existing))
+
+        # Downloaded one after the other, yf.download is not safe to call concurrently.
+        frames: list[pd.DataFrame] = []
+        if existing:
+            # BDay(0) rolls a weekend start forward to Monday so no request is made for days without trading.
+            global_start: pd.Timestamp = filter_df['MAX_DATE'].min() + pd.Timedelta(days=1) + pd.offsets.BDay(0)
+            if global_start <= pd.Timestamp.today().normalize():
+                frames.append(self.yf_data.price_data(tickers=existing, start=global_start.strftime('%Y-%m-%d')))
+        if missing:
+            frames.append(self.yf_data.price_data(tickers=missing))
+
+        frames: list[pd.DataFrame] = [f for f in frames if len(f) > 0]
+        if not frames:
+            print("No valid rows to ingest")
+            return 0
 
-        merged: pd.DataFrame = df.merge(
-            right=filter_df,
-            on='TICKER',
-            how='left'
-        )
-
-        merged: pd.DataFrame = merged[(merged['DATE'] > merged['MAX_DATE']) | (merged['MAX_DATE'].isna())]
-        merged.drop(columns='MAX_DATE', inplace=True)
+        df: pd.DataFrame = pd.concat(frames, ignore_index=True)
 
-        if len(merged) > 0:
-            write_pandas(
-                conn=self.conn,
-                df=merged,
-                table_name="TICKER_DATA",
-                auto_create_table=False
-            )
+        # OHLC stays float64, float32 loses the 4th decimal NUMBER(18,4) stores once prices reach ~1024.
+        df["VOLUME"] = df["VOLUME"].astype("Int64")
+        # Arrow date32 is written to parquet as a DATE logical type, which COPY loads straight into the DATE column.
+        df["DATE"] = df["DATE"].astype("date32[pyarrow]")
 
-            ticker_counts: pd.Series = merged.groupby('TICKER').size()
+        self._stage_df(df=df, stg_name="STG_TICKER_DATA", like="TICKER_DATA")
+        self.cursor.execute("""
+            MERGE INTO TICKER_DATA t
+            USING STG_TICKER_DATA s
+            ON t.ticker = s.ticker AND t.date = s.date
+            WHEN NOT MATCHED THEN
+                INSERT (date, ticker, open, high, low, close, adj_close, volume)
+                VALUES (s.date, s.ticker, s.open, s.high, s.low, s.close, s.adj_close, s.volume)
+        """)
 
-            return ticker_counts
-        
-        else:
+        if self.cursor.rowcount == 0:
             print("No valid rows to ingest")
 
+        return self.cursor.rowcount
+
     def load_ticker_profiles(self) -> int:
         """
         Method to compare tickers in the DB against newly sourced ones, and load only ones that don't already exist.
-        SET has been applied to tickers in python before they are ingested hence:
-            SELECT ticker FROM ticker_profiles does not require DISTINCT which would slow the query down.
+        Sourced profiles are staged into a transient table and anti-joined against TICKER_PROFILES server side,
+        so existing tickers are never pulled back to the client.
 
         Returns
             int -> Count of new tickers added.
         """
         df: pd.DataFrame = self.yf_data.threaded_profiling()
-        existing: pd.DataFrame = pd.read_sql_query(sql="""SELECT ticker FROM stock_profiles""", con=self.conn)
-        existing_tickers: set[str] = set(existing["TICKER"].str.upper())
-        df: pd.DataFrame = df[~df["TICKER"].str.upper().isin(existing_tickers)]
-
-        if len(df) > 0:
-            write_pandas(
-                conn=self.conn,
-                df=df,
-                table_name="TICKER_PROFILES",
-                auto_create_table=False
-            )
-
-            return len(df)
-        
-        else:
+        if len(df) == 0:
             return 0
 
+        self._stage_df(df=df, stg_name="STG_PROFILES", like="TICKER_PROFILES")
+        self.cursor.execute("""
+            INSERT INTO TICKER_PROFILES
+            SELECT
+                s.*
+            FROM
+                STG_PROFILES s
+            LEFT JOIN
+                TICKER_PROFILES e
+            ON
+                s.ticker = e.ticker
+            WHERE
+                e.ticker IS NULL
+        """)
+
+        return self.cursor.rowcount
+
     def run(self) -> None:
         self.table_creator()
-        price: Optional[pd.Series] = self.load_price_data()
+        price: int = self.load_price_data()
         profiles: int = self.load_ticker_profiles()
 
-        print(price)
+        print(f'{price} new price rows ingested')
         print(f'{profiles} new profiles ingested')
 
 
-pipeline(tickers=stock_tickers, db_schema='snowflake_schemas.yaml').run()
\ No newline at end of file
+if __name__ == '__main__':
+    with pipeline(tickers=stock_tickers, db_schema='snowflake_schemas.yaml') as p:
+        p.run()